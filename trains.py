@@ -1,19 +1,45 @@
 __version__ = "0.1"
 __author__ = "Matteo Delton"
 
+import atexit
+import json
 import logging
+import os
+import re
 from argparse import ArgumentParser, BooleanOptionalAction
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
 
-import inquirer
 from ansicolors import Foreground as F
 from ansicolors import Style as S
-from prettytable import PrettyTable
 from viaggiatreno import ViaggiaTrenoAPIWrapper as API
 
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "orariotreni"
+)
+STATIONS_CACHE = CACHE_DIR / "stations.json"
+STATIONS_CATALOG = CACHE_DIR / "catalog.json"
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+# A station id (S01700) or a bare ENEE code (1700)
+STATION_ID = re.compile(r"S?(\d{1,5})", re.ASCII | re.IGNORECASE)
+
+# Threads are started as needed and reused across boards
+_executor = ThreadPoolExecutor(max_workers=API.POOL_SIZE, thread_name_prefix="ot")
+
 
 class Train:
+    # category and number_changes are set after construction
+    __slots__ = (
+        "departure_station",
+        "train_number",
+        "departure_date",
+        "category",
+        "number_changes",
+    )
+
     def __init__(self, departure_station, train_number, departure_date):
         self.departure_station = departure_station
         self.train_number = train_number
@@ -44,8 +70,108 @@ def show_statistics():
     )
 
 
+def _select(message, choices):
+    """Let the user pick one of choices, a list of (title, value) pairs,
+    and return the chosen value.
+    """
+    # Imported here because loading it is slow and it's only needed
+    # when there's actually something to choose
+    import questionary
+
+    # unsafe_ask lets Ctrl-C interrupt the program, as inquirer did,
+    # instead of returning None to callers that expect a choice
+    return questionary.select(
+        message,
+        choices=[questionary.Choice(t, v) for t, v in choices],
+    ).unsafe_ask()
+
+
+def _load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+@lru_cache(maxsize=None)
+def _stations_cache():
+    """Return the stations looked up so far, reading them on first use
+    so that runs which don't look up stations don't pay for it.
+    """
+    return _load_json(STATIONS_CACHE, {})
+
+
+@lru_cache(maxsize=None)
+def _stations_catalog():
+    """Return the catalog of all the stations, reading it on first use."""
+    return _load_json(STATIONS_CATALOG, [])
+
+
+_stations_cache_dirty = False
+
+
+@atexit.register
+def _save_stations_cache():
+    if not _stations_cache_dirty:
+        return
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(STATIONS_CACHE, "w") as f:
+            json.dump(_stations_cache(), f)
+    except OSError as e:
+        logging.warning(f"Could not save the stations cache: {e}")
+
+
+def update_stations_catalog():
+    """Download the list of all the stations, so that names can be
+    looked up without asking ViaggiaTreno.
+    """
+    stations = API.get_all_stations()
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(STATIONS_CATALOG, "w") as f:
+        json.dump(stations, f)
+
+    print(f"Salvate {len(stations)} stazioni")
+
+
+def _get_stations(prefix):
+    """Return the stations starting with prefix, asking ViaggiaTreno
+    only if they can't be found locally.
+
+    Stations change very rarely, so results are kept on disk across
+    runs. The catalog saved by update_stations_catalog, if any, is
+    searched first.
+    """
+    global _stations_cache_dirty
+
+    key = prefix.upper()
+
+    if stations := [s for s in _stations_catalog() if s["name"].startswith(key)]:
+        return stations
+
+    cache = _stations_cache()
+    if key not in cache:
+        stations = API.get_stations_matching_prefix(prefix)
+        if not stations:
+            return stations
+
+        cache[key] = stations
+        _stations_cache_dirty = True
+
+    return cache[key]
+
+
 def choose_station(station):
-    s = API.get_stations_matching_prefix(station)
+    # Ids (S01700) and bare ENEE codes (1700) need no lookup, but there's
+    # no name to show other than the id itself
+    if m := STATION_ID.fullmatch(station):
+        id = f"S{int(m[1]):05}"
+        return id, id
+
+    s = _get_stations(station)
 
     if not s:
         print("Nessuna stazione trovata")
@@ -55,7 +181,7 @@ def choose_station(station):
         return s[0]["name"], s[0]["id"]
 
     guesses = [(s["name"], s["id"]) for s in s]
-    choice = inquirer.list_input(message="Seleziona la stazione", choices=guesses)
+    choice = _select("Seleziona la stazione", guesses)
 
     name = next(s[0] for s in guesses if s[1] == choice)
     id = choice
@@ -63,6 +189,7 @@ def choose_station(station):
     return name, id
 
 
+@lru_cache(maxsize=128)
 def _get_track(actual_track, scheduled_track, probable_track=None):
     if actual_track is not None:
         if scheduled_track is not None:
@@ -83,6 +210,7 @@ def _get_track(actual_track, scheduled_track, probable_track=None):
     return ""
 
 
+@lru_cache(maxsize=128)
 def _get_delay(delay, departed_from_origin, actual_departure_track_known=False):
     if departed_from_origin:
         if delay > 0:
@@ -97,9 +225,11 @@ def _get_delay(delay, departed_from_origin, actual_departure_track_known=False):
         return "Non partito"
 
 
-def _process_train(t, station_id, is_departure):
+def _basic_row(t, is_departure):
+    """Return the row for a train using only departures/arrivals data."""
     train = Train(t["origin_id"], t["number"], t["departure_date"])
     train.category = t["category"]
+    train.number_changes = None
 
     delay = _get_delay(t["delay"], t["departed_from_origin"])
     track = _get_track(t["actual_track"], t["scheduled_track"])
@@ -111,23 +241,21 @@ def _process_train(t, station_id, is_departure):
         dest_or_origin = t["origin"]
         time = t["arrival_time"]
 
-    # Update with more accurate data
-    progress = API.get_train_progress(t["origin_id"], t["number"], t["departure_date"])
+    return [train, dest_or_origin, time.strftime("%H:%M"), delay, track]
 
-    train.number_changes = progress["train_number_changes"] if progress else None
 
-    # ViaggiaTreno is not providing real-time updates
-    if not progress:
-        res = [train, dest_or_origin, time.strftime("%H:%M"), delay, track]
-        for i, r in enumerate(res):
-            res[i] = F.yellow(r)
-        return res
+def _process_train(t, station_id, is_departure, progress):
+    res = _basic_row(t, is_departure)
+
+    if progress:
+        res[0].number_changes = progress["train_number_changes"]
 
     departure = None
     stop = None
     arrival = None
 
-    for s in progress["stops"]:
+    # A single pass finds all the stops we need
+    for s in progress["stops"] if progress else ():
         if s["stop_type"] == "P":
             departure = s
 
@@ -137,6 +265,13 @@ def _process_train(t, station_id, is_departure):
         if s["stop_type"] == "A":
             arrival = s
 
+    # ViaggiaTreno is not providing real-time updates, or it's not
+    # listing this station among the stops of the train. The Train is
+    # left as is, since it's what the user picks to see its progress
+    if stop is None:
+        res[1:] = map(F.yellow, res[1:])
+        return res
+
     # It happens e.g. with train 2965 Saronno -> Milano Centrale
     if not departure:
         departure = progress["stops"][0]
@@ -164,23 +299,80 @@ def _process_train(t, station_id, is_departure):
     arrived = stop["actual_arrival_time"] is not None
     departed = stop["actual_departure_time"] is not None
 
-    res = [train, dest_or_origin, time.strftime("%H:%M"), delay, track]
+    res[3:] = [delay, track]
 
     if arrived and (departed or arrival["actual_arrival_time"]):
-        for i, r in enumerate(res):
-            if i == 0:
-                continue
-            res[i] = S.dim(r)
+        res[1:] = map(S.dim, res[1:])
     elif arrived and not departed:
-        for i, r in enumerate(res):
-            if i == 0:
-                continue
-            res[i] = S.bold(r)
+        res[1:] = map(S.bold, res[1:])
 
     return res
 
 
-def show_departures(station_name, station_id, dt, limit):
+def _process_trains(trains, station_id, is_departure, details=True):
+    """Return the table rows for the given trains, in the same order.
+
+    Fetching the progress of each train is the slow part, so the
+    requests are issued concurrently, once per distinct train, and each
+    row is built as soon as its progress arrives. Without details, the
+    progress isn't fetched at all.
+    """
+    if not details:
+        return [_basic_row(t, is_departure) for t in trains]
+
+    positions = {}
+    for i, t in enumerate(trains):
+        key = (t["origin_id"], t["number"], t["departure_date"])
+        positions.setdefault(key, []).append(i)
+
+    futures = {
+        _executor.submit(API.get_train_progress, *key, station_id): key
+        for key in positions
+    }
+
+    # Progress is more accurate than departures/arrivals data
+    rows = [None] * len(trains)
+    for future in as_completed(futures):
+        progress = future.result()
+        for i in positions[futures[future]]:
+            rows[i] = _process_train(trains[i], station_id, is_departure, progress)
+
+    return rows
+
+
+@lru_cache(maxsize=128)
+def _visible_len(text):
+    """Return the length of text as shown on the terminal."""
+    return len(ANSI_ESCAPE.sub("", text))
+
+
+def _render_table(field_names, rows):
+    """Return the rows as a table with centered cells.
+
+    Cells may contain ANSI escape sequences, which don't count towards
+    the width of their column.
+    """
+    cells = [list(field_names)] + [list(map(str, r)) for r in rows]
+    lengths = [list(map(_visible_len, r)) for r in cells]
+    widths = [max(col) for col in zip(*lengths)]
+
+    border = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+
+    # Bound once instead of looking up .append for every cell
+    lines = []
+    add_line = lines.append
+    for r, lens in zip(cells, lengths):
+        line = []
+        add_cell = line.append
+        for c, n, w in zip(r, lens, widths):
+            left = (w - n) // 2
+            add_cell(" " * (left + 1) + c + " " * (w - n - left + 1))
+        add_line("|" + "|".join(line) + "|")
+
+    return "\n".join([border, lines[0], border, *lines[1:], border])
+
+
+def show_departures(station_name, station_id, dt, limit, details=True):
     print(S.bold(f"Partenze da {station_name}"))
 
     departures = API.get_departures(station_id, dt, limit)
@@ -188,27 +380,18 @@ def show_departures(station_name, station_id, dt, limit):
         print("Nessun treno in partenza nei prossimi 90 minuti.")
         return
 
-    table = PrettyTable()
-    table.field_names = ["Treno", "Destinazione", "Partenza", "Ritardo", "Binario"]
-
-    choices = []
-    with ThreadPoolExecutor(max_workers=len(departures)) as executor:
-        futures = [
-            executor.submit(_process_train, t, station_id, True) for t in departures
-        ]
+    rows = _process_trains(departures, station_id, True, details)
+    choices = [(str(t[0]), t[0]) for t in rows]
 
-        for future in futures:
-            t = future.result()
-            table.add_row(t)
-            choices.append((str(t[0]), t[0]))
-
-    print(table)
+    print(
+        _render_table(["Treno", "Destinazione", "Partenza", "Ritardo", "Binario"], rows)
+    )
 
-    choice = inquirer.list_input(message="Seleziona un treno", choices=choices)
+    choice = _select("Seleziona un treno", choices)
     show_progress(choice)
 
 
-def show_arrivals(station_name, station_id, dt, limit):
+def show_arrivals(station_name, station_id, dt, limit, details=True):
     print(S.bold(f"Arrivi a {station_name}"))
 
     arrivals = API.get_arrivals(station_id, dt, limit)
@@ -216,19 +399,9 @@ def show_arrivals(station_name, station_id, dt, limit):
         print("Nessun treno in arrivo nei prossimi 90 minuti.")
         return
 
-    table = PrettyTable()
-    table.field_names = ["Treno", "Provenienza", "Arrivo", "Ritardo", "Binario"]
-
-    with ThreadPoolExecutor(max_workers=len(arrivals)) as executor:
-        futures = [
-            executor.submit(_process_train, t, station_id, False) for t in arrivals
-        ]
+    rows = _process_trains(arrivals, station_id, False, details)
 
-        for future in futures:
-            t = future.result()
-            table.add_row(t)
-
-    print(table)
+    print(_render_table(["Treno", "Provenienza", "Arrivo", "Ritardo", "Binario"], rows))
 
 
 def show_progress(train):
@@ -356,6 +529,18 @@ if __name__ == "__main__":
         help="show/don't show statistics about trains (defaults to True)",
         default=True,
     )
+    ap.add_argument(
+        "--details",
+        action=BooleanOptionalAction,
+        help="check the progress of each departing/arriving train for "
+        "more accurate delays and tracks (defaults to True)",
+        default=True,
+    )
+    ap.add_argument(
+        "--update-stations",
+        action="store_true",
+        help="download the list of all the stations to look them up offline",
+    )
     ap.add_argument(
         "--log-level",
         metavar="LEVEL",
@@ -382,6 +567,9 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=args.log_level)
 
+    if args.update_stations:
+        update_stations_catalog()
+
     if args.stats:
         show_statistics()
 
@@ -402,11 +590,11 @@ if __name__ == "__main__":
 
     if args.departures:
         station_name, station_id = choose_station(args.departures)
-        show_departures(station_name, station_id, dt, limit)
+        show_departures(station_name, station_id, dt, limit, args.details)
 
     if args.arrivals:
         station_name, station_id = choose_station(args.arrivals)
-        show_arrivals(station_name, station_id, dt, limit)
+        show_arrivals(station_name, station_id, dt, limit, args.details)
 
     if args.solutions:
         print("Not implemented yet")
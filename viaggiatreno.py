@@ -1,9 +1,20 @@
 __version__ = "0.1"
 __author__ = "Matteo Delton"
 
+import string
 from datetime import date, datetime, time
+from functools import lru_cache, singledispatch
+from time import localtime, strftime
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional, it just makes parsing big responses faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class ViaggiaTrenoAPIWrapper:
@@ -23,13 +34,34 @@ class ViaggiaTrenoAPIWrapper:
 
     BASE_URI = "http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno"
 
+    # Callers issuing concurrent requests should not exceed it
+    POOL_SIZE = 32
+
+    # A single session lets concurrent requests (e.g. the progress of
+    # every train in a departures board) reuse keep-alive connections
+    # instead of opening a new one each time. The pool must be at least
+    # as large as the number of concurrent requests, otherwise extra
+    # connections are discarded after use
+    _session = requests.Session()
+    _session.mount(
+        "http://",
+        HTTPAdapter(
+            pool_connections=POOL_SIZE,
+            pool_maxsize=POOL_SIZE,
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        ),
+    )
+
     @classmethod
     def _get(cls, endpoint, *args):
         url = f'{cls.BASE_URI}/{endpoint}/{"/".join(str(arg) for arg in args)}'
-        r = requests.get(url)
+        r = cls._session.get(url)
         r.raise_for_status()
 
-        return r.json() if "json" in r.headers["Content-Type"] else r.text
+        if "json" not in r.headers["Content-Type"]:
+            return r.text
+
+        return orjson.loads(r.content) if orjson else r.json()
 
     @classmethod
     def get_statistics(cls):
@@ -56,6 +88,19 @@ class ViaggiaTrenoAPIWrapper:
 
         return stations
 
+    @classmethod
+    def get_all_stations(cls):
+        """Return every station, asking autocompletaStazione for each
+        letter of the alphabet.
+        """
+        stations = {}
+        for letter in string.ascii_uppercase:
+            for line in cls._get("autocompletaStazione", letter).splitlines():
+                name, id = line.rsplit("|", 1)
+                stations[id] = name
+
+        return [{"name": name, "id": id} for id, name in stations.items()]
+
     @classmethod
     def get_departures(cls, station_id, dt=None, limit=10):
         """Return the departures from a station at a certain time."""
@@ -178,8 +223,29 @@ class ViaggiaTrenoAPIWrapper:
         return solutions
 
     @classmethod
-    def get_train_progress(cls, origin_id, train_number, dep_date):
-        """Return the progress of a train."""
+    def _parse_stop(cls, s):
+        return {
+            "station_id": s["id"],
+            "station_name": s["stazione"],
+            "scheduled_arrival_time": Utils.from_ms_timestamp(s["arrivo_teorico"]),
+            "actual_arrival_time": Utils.from_ms_timestamp(s["arrivoReale"]),
+            "scheduled_departure_time": Utils.from_ms_timestamp(s["partenza_teorica"]),
+            "actual_departure_time": Utils.from_ms_timestamp(s["partenzaReale"]),
+            "scheduled_arrival_track": s["binarioProgrammatoArrivoDescrizione"],
+            "actual_arrival_track": s["binarioEffettivoArrivoDescrizione"],
+            "scheduled_departure_track": s["binarioProgrammatoPartenzaDescrizione"],
+            "actual_departure_track": s["binarioEffettivoPartenzaDescrizione"],
+            "stop_type": s["tipoFermata"],
+        }
+
+    @classmethod
+    def get_train_progress(cls, origin_id, train_number, dep_date, station_id=None):
+        """Return the progress of a train.
+
+        If station_id is given, only the stops needed to describe the
+        train at that station are returned: the station itself, the
+        departure and arrival stops and the first and last ones.
+        """
         dep_date = Utils.to_ms_date_timestamp(dep_date)
         r = cls._get("andamentoTreno", origin_id, train_number, dep_date)
 
@@ -193,30 +259,15 @@ class ViaggiaTrenoAPIWrapper:
             )
 
         stops = []
-        for s in r["fermate"]:
-            stops.append(
-                {
-                    "station_id": s["id"],
-                    "station_name": s["stazione"],
-                    "scheduled_arrival_time": Utils.from_ms_timestamp(
-                        s["arrivo_teorico"]
-                    ),
-                    "actual_arrival_time": Utils.from_ms_timestamp(s["arrivoReale"]),
-                    "scheduled_departure_time": Utils.from_ms_timestamp(
-                        s["partenza_teorica"]
-                    ),
-                    "actual_departure_time": Utils.from_ms_timestamp(
-                        s["partenzaReale"]
-                    ),
-                    "scheduled_arrival_track": s["binarioProgrammatoArrivoDescrizione"],
-                    "actual_arrival_track": s["binarioEffettivoArrivoDescrizione"],
-                    "scheduled_departure_track": s[
-                        "binarioProgrammatoPartenzaDescrizione"
-                    ],
-                    "actual_departure_track": s["binarioEffettivoPartenzaDescrizione"],
-                    "stop_type": s["tipoFermata"],
-                }
-            )
+        last = len(r["fermate"]) - 1
+        for i, s in enumerate(r["fermate"]):
+            if (
+                station_id is None
+                or s["id"] == station_id
+                or s["tipoFermata"] in ("P", "A")
+                or i in (0, last)
+            ):
+                stops.append(cls._parse_stop(s))
 
         # Check fermateSoppresse, tipoTreno and motivoRitardoPrevalente
         # There's a numeroTreno which is an int here
@@ -246,6 +297,39 @@ class ViaggiaTrenoAPIWrapper:
         return progress
 
 
+@singledispatch
+def _to_datetime(value):
+    """Return value as a datetime.
+
+    The value can be a datetime, a date (taken at midnight), a timestamp
+    in milliseconds or a string in ISO 8601 format.
+    """
+    raise TypeError(f"Invalid date type: {type(value).__name__}")
+
+
+@_to_datetime.register
+def _(value: datetime):
+    return value
+
+
+@_to_datetime.register
+def _(value: date):
+    return datetime.combine(value, time.min)
+
+
+@_to_datetime.register
+def _(value: int):
+    return datetime.fromtimestamp(value / 1000)
+
+
+@_to_datetime.register
+def _(value: str):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date format: {value}") from None
+
+
 class Utils:
     """A collection of utility functions."""
 
@@ -257,29 +341,20 @@ class Utils:
         The date can be a date, a datetime, a timestamp in milliseconds
         or a string in ISO 8601 format.
         """
-        if isinstance(date_, date):
-            dt = datetime.combine(date_, time.min)
-        elif isinstance(date_, datetime):
-            dt = datetime.combine(date_.date(), time.min)
-        elif isinstance(date_, int):
-            dt = datetime.fromtimestamp(date_ / 1000)
-            dt = datetime.combine(dt.date(), time.min)
-        elif isinstance(date_, str):
-            try:
-                dt = datetime.fromisoformat(date_)
-            except ValueError:
-                raise ValueError(f"Invalid date format: {date_}") from None
+        dt = datetime.combine(_to_datetime(date_).date(), time.min)
 
         return int(dt.timestamp() * 1000)
 
     @classmethod
     def to_string(cls, dt):
-        if isinstance(dt, int):
-            dt = datetime.fromtimestamp(dt / 1000)
-        elif isinstance(dt, str):
-            dt = datetime.fromisoformat(dt)
+        return cls._format_timestamp(int(_to_datetime(dt).timestamp()))
 
-        return dt.strftime("%a %b %d %Y %H:%M:%S")
+    # strftime is slow and the same few instants get formatted
+    # repeatedly, so the result is cached by timestamp in seconds
+    @classmethod
+    @lru_cache(maxsize=16)
+    def _format_timestamp(cls, seconds):
+        return strftime("%a %b %d %Y %H:%M:%S", localtime(seconds))
 
     @classmethod
     def get_enee_code(cls, station_id):